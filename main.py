@@ -1,22 +1,76 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-import json, os
+from fastapi.responses import ORJSONResponse
+import asyncio, hashlib, itertools, os, secrets
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import httpx
+import orjson
 from supabase import create_client, Client
 
 # Vertex AI SDK
 import vertexai
 from vertexai.preview.vision_models import ImageGenerationModel, Image
 
-app = FastAPI()
+# Use uvloop's faster event loop when available (not on Windows)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # --- Define the clients globally ---
 supabase: Client | None = None
 generation_model: ImageGenerationModel | None = None
+BUCKET_NAME: str | None = None
+STORAGE = None  # Supabase storage bucket handle, resolved once at startup
+PUBLIC_URL_PREFIX: str | None = None  # deterministic public-object URL base
 
-# --- Run this after the app starts ---
-@app.on_event("startup")
-def startup_event():
-    global supabase, generation_model
+def _with_reconnect(call, *args, **kwargs):
+    """Run a Supabase call, retrying once on transport errors.
+
+    A keepalive connection in the bounded pool can go stale between
+    requests; the retry reconnects instead of surfacing a raw 500.
+    """
+    try:
+        return call(*args, **kwargs)
+    except httpx.TransportError:
+        return call(*args, **kwargs)
+
+def _init_vertex(project_id: str, location: str, model_name: str):
+    global generation_model
+    vertexai.init(project=project_id, location=location)
+    print(f"Loading model: {model_name}")
+    generation_model = ImageGenerationModel.from_pretrained(model_name)
+
+def _init_supabase(url: str, key: str):
+    global supabase, STORAGE
+    supabase = create_client(url, key)
+
+    # Swap in httpx sessions with an explicit bounded pool so N workers
+    # can't exhaust Supabase's connection limit (reaches into
+    # supabase-py internals; revisit if the client grows a public knob).
+    # Rebuild through the library's own client class, carrying over its
+    # transport config, and close the old session so its sockets are
+    # released rather than leaked.
+    limits = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+    for holder, attr in ((supabase.postgrest, "session"), (supabase.storage, "_client")):
+        old = getattr(holder, attr)
+        setattr(holder, attr, old.__class__(
+            base_url=old.base_url,
+            headers=old.headers,
+            timeout=old.timeout,
+            follow_redirects=old.follow_redirects,
+            limits=limits,
+        ))
+        old.close()
+
+    STORAGE = supabase.storage.from_(BUCKET_NAME)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global BUCKET_NAME, PUBLIC_URL_PREFIX
 
     # Load environment variables
     GOOGLE_PROJECT_ID = os.getenv("GOOGLE_PROJECT_ID")
@@ -24,29 +78,40 @@ def startup_event():
     SUPABASE_URL = os.getenv("SUPABASE_URL")
     SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
     IMAGEN_MODEL_NAME = os.getenv("IMAGEN_MODEL_NAME")
+    BUCKET_NAME = os.getenv("BUCKET")
 
     # Check for missing environment variables
-    if not all([GOOGLE_PROJECT_ID, GOOGLE_LOCATION, SUPABASE_URL, SUPABASE_KEY, IMAGEN_MODEL_NAME]):
+    if not all([GOOGLE_PROJECT_ID, GOOGLE_LOCATION, SUPABASE_URL, SUPABASE_KEY, IMAGEN_MODEL_NAME, BUCKET_NAME]):
         print("ERROR: One or more environment variables are missing. Please ensure all are set.")
         if not GOOGLE_PROJECT_ID: print("  - GOOGLE_PROJECT_ID is missing")
         if not GOOGLE_LOCATION: print("  - GOOGLE_LOCATION is missing")
         if not SUPABASE_URL: print("  - SUPABASE_URL is missing")
         if not SUPABASE_KEY: print("  - SUPABASE_KEY is missing")
         if not IMAGEN_MODEL_NAME: print("  - IMAGEN_MODEL_NAME is missing")
+        if not BUCKET_NAME: print("  - BUCKET is missing")
+        yield
         return
 
+    # Supabase public-object URLs are deterministic, so build the prefix
+    # once instead of calling get_public_url per request
+    PUBLIC_URL_PREFIX = f"{SUPABASE_URL}/storage/v1/object/public/{BUCKET_NAME}/"
+
     try:
         print("Initializing Supabase and Vertex AI clients...")
-        vertexai.init(project=GOOGLE_PROJECT_ID, location=GOOGLE_LOCATION)
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-        print(f"Loading model: {IMAGEN_MODEL_NAME}")
-        generation_model = ImageGenerationModel.from_pretrained(IMAGEN_MODEL_NAME)
-
+        # Both inits are blocking network I/O; warm them concurrently so
+        # cold start costs max(vertex, supabase) instead of the sum
+        await asyncio.gather(
+            asyncio.to_thread(_init_vertex, GOOGLE_PROJECT_ID, GOOGLE_LOCATION, IMAGEN_MODEL_NAME),
+            asyncio.to_thread(_init_supabase, SUPABASE_URL, SUPABASE_KEY),
+        )
         print("Clients initialized successfully.")
     except Exception as e:
         print(f"FATAL: Error during client initialization: {e}")
 
+    yield
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
 # Enable CORS for all domains
 app.add_middleware(
     CORSMiddleware,
@@ -56,9 +121,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-stage concurrency caps: each request flows read -> generate -> upload,
+# and bounding the two blocking stages separately lets one request's Vertex
+# call overlap another's Supabase upload without exhausting the thread pool.
+GEN_CONCURRENCY = int(os.getenv("GEN_CONCURRENCY", "4"))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+_gen_semaphore = asyncio.Semaphore(GEN_CONCURRENCY)
+_upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+# Filename disambiguation: one random seed per process plus a counter,
+# instead of a getrandom syscall on every request
+_FNAME_SEED = secrets.token_hex(6)
+_FNAME_CTR = itertools.count()
+
+# Reject junk before it costs a Vertex call
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+
+# Exact-match result cache: (image content hash, prompt_id) -> public URL.
+# Re-submitting the same photo with the same prompt skips the multi-second
+# Vertex call entirely. Bounded LRU, per process.
+_RESULT_CACHE: OrderedDict[str, str] = OrderedDict()
+_RESULT_CACHE_MAX = 256
+
+@dataclass(slots=True, frozen=True)
+class Prompt:
+    """One prompts.json entry as a fixed-layout record instead of a dict."""
+    id: int
+    title: str
+    prompt_text: str
+
 # Load prompts from JSON
-with open("prompts.json", "r") as f:
-    PROMPTS = json.load(f)
+with open("prompts.json", "rb") as f:
+    PROMPTS = [Prompt(p["id"], p["title"], p["promptText"]) for p in orjson.loads(f.read())]
+
+# Precomputed lookups so request handlers don't re-scan PROMPTS
+PROMPT_BY_ID = {p.id: p.prompt_text for p in PROMPTS}
+PROMPT_INDEX = [{"id": p.id, "title": p.title} for p in PROMPTS]
+_PROMPTS_JSON = orjson.dumps(PROMPT_INDEX)
 
 @app.get("/")
 async def read_root():
@@ -66,45 +165,83 @@ async def read_root():
 
 @app.get("/prompts")
 def get_prompts():
-    return [{"id": p["id"], "title": p["title"]} for p in PROMPTS]
+    # Serve the response bytes serialized once at startup
+    return Response(content=_PROMPTS_JSON, media_type="application/json")
 
 @app.post("/generate-image")
 async def generate_image(prompt_id: int, file: UploadFile = File(...)):
-    if not generation_model or not supabase:
+    if not generation_model or not supabase or not STORAGE:
         raise HTTPException(status_code=503, detail="Service not ready. AI or Database client failed to initialize. Check server logs.")
 
-    prompt = next((p["promptText"] for p in PROMPTS if p["id"] == prompt_id), None)
+    prompt = PROMPT_BY_ID.get(prompt_id)
     if not prompt:
         raise HTTPException(status_code=404, detail="Prompt not found")
 
-    image_bytes = await file.read()
+    # Reject invalid uploads before touching the body: a bad request
+    # should fail in microseconds, not occupy a Vertex quota slot
+    if not (file.content_type or "").startswith("image/"):
+        raise HTTPException(status_code=415, detail="Upload must be an image")
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} byte limit")
+
+    # Accumulate the upload in chunks rather than one full read(); the
+    # bytearray is bytes-like, so Vertex accepts it without another
+    # full-size copy of the spooled upload.
+    image_bytes = bytearray()
+    while chunk := await file.read(65536):
+        image_bytes += chunk
+        # enforce the cap even when the client omits Content-Length
+        if len(image_bytes) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} byte limit")
+    # sha256 over blake2b: OpenSSL dispatches it to the CPU's SHA
+    # extensions, which matters when hashing multi-MB photos per request
+    cache_key = hashlib.sha256(image_bytes).hexdigest()[:32] + ":" + str(prompt_id)
+    cached_url = _RESULT_CACHE.get(cache_key)
+    if cached_url is not None:
+        _RESULT_CACHE.move_to_end(cache_key)
+        return {"image_url": cached_url}
+
     source_image = Image(image_bytes=image_bytes)
 
     try:
-        response = generation_model.edit_image(
-            base_image=source_image,
-            prompt=prompt,
-            number_of_images=1,
-        )
+        # Blocking Vertex AI call; run it off the event loop so
+        # concurrent requests can make progress
+        async with _gen_semaphore:
+            response = await asyncio.to_thread(
+                generation_model.edit_image,
+                base_image=source_image,
+                prompt=prompt,
+                number_of_images=1,
+            )
         new_image_bytes = response.images[0]._image_bytes  # raw bytes
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Image generation failed: {e}")
 
     try:
-        filename = f"generated_{prompt_id}_{os.urandom(4).hex()}.png"
-        bucket_name_supabase = os.getenv("BUCKET")
-        if not bucket_name_supabase:
-            raise ValueError("SUPABASE BUCKET environment variable (BUCKET) is not set.")
+        filename = f"generated_{prompt_id}_{_FNAME_SEED}_{next(_FNAME_CTR):x}.png"
 
         # Corrected upload call: filename first, then bytes, no BytesIO wrapping
-        supabase.storage.from_(bucket_name_supabase).upload(
-            filename,
-            new_image_bytes,
-            file_options={"content-type": "image/png"}
-        )
-
-        public_url = supabase.storage.from_(bucket_name_supabase).get_public_url(filename)
+        # (blocking Supabase calls also go through the thread pool).
+        # Post-generation writes are independent of each other, so they run
+        # as a gather; future audit-log or DB-row writes join this list
+        # instead of serializing after the upload.
+        async with _upload_semaphore:
+            await asyncio.gather(
+                asyncio.to_thread(
+                    _with_reconnect,
+                    STORAGE.upload,
+                    filename,
+                    new_image_bytes,
+                    file_options={"content-type": "image/png"}
+                ),
+            )
+
+        public_url = PUBLIC_URL_PREFIX + filename
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"File upload to Supabase failed: {e}")
 
+    _RESULT_CACHE[cache_key] = public_url
+    if len(_RESULT_CACHE) > _RESULT_CACHE_MAX:
+        _RESULT_CACHE.popitem(last=False)
+
     return {"image_url": public_url}